@@ -0,0 +1,247 @@
+"""
+This module maintains summary tables of the ranking rows stored in the SQLite database.
+
+agg_rankings holds one row per dataset, dimension and value with the number of ranked
+companies and the sum of their scores. Triggers on rankings_raw update it whenever a dataset
+is ingested or re-scraped, so summaries never have to scan the raw rows. Rows without a
+dataset_id belong to no ranking and are left out.
+
+Dimensions:
+    all: one row per dataset (ranking sizes)
+    industry, state, employees: company counts by industry, state and employee band
+    score_band: the score distribution in bands of 10 points
+
+Functions:
+    create_aggregates: creates the table and its triggers and builds it from rankings_raw
+    ensure_aggregates: creates the table only if it or one of its triggers is missing
+    rebuild_aggregates: recomputes the table from rankings_raw
+    get_summary: reads a summary of one dimension grouped by dataset attributes
+    check_aggregates: compares the table with a full recompute
+"""
+import pandas as pd
+from dei_rankings import logging_config, data
+
+logger = logging_config.logger
+
+AGG_TABLE = 'agg_rankings'
+
+# SQL expression for the value of each dimension, {row} is new, old or a table alias
+DIMENSIONS = {
+    'all': "''",
+    'industry': "COALESCE({row}.industry, '')",
+    'state': "COALESCE({row}.state, '')",
+    'employees': "COALESCE({row}.employees, '')",
+    'score_band':
+        "COALESCE(CAST(CAST(CAST({row}.score AS REAL) / 10 AS INTEGER) * 10 AS TEXT), '')",
+}
+
+# dimensions whose values are numbers stored as text, read back as integers so they sort
+# numerically (a missing score is stored as '' and read back as NULL)
+INTEGER_DIMENSIONS = ['score_band']
+
+AGG_TRIGGERS = [f'{AGG_TABLE}_{event}' for event in ('insert', 'delete', 'update')]
+
+SUMMARY_GROUPS = ['study', 'country', 'year', 'chart_title', 'filename', 'dataset_id']
+
+
+def _score(row):
+    return f"CAST({row}.score AS REAL)"
+
+
+def _add_statements(row):
+    """Statements adding a rankings_raw row to the aggregates."""
+    return [f"""
+        INSERT INTO {AGG_TABLE} (dataset_id, dimension, value, n_rows, n_scored, score_sum)
+        SELECT {row}.dataset_id, '{dimension}', {expression.format(row=row)}, 1,
+               {_score(row)} IS NOT NULL, COALESCE({_score(row)}, 0)
+        WHERE {row}.dataset_id IS NOT NULL
+        ON CONFLICT (dataset_id, dimension, value) DO UPDATE SET
+            n_rows = n_rows + 1,
+            n_scored = n_scored + excluded.n_scored,
+            score_sum = score_sum + excluded.score_sum;
+        """ for dimension, expression in DIMENSIONS.items()]
+
+
+def _remove_statements(row):
+    """Statements removing a rankings_raw row from the aggregates."""
+    statements = [f"""
+        UPDATE {AGG_TABLE} SET
+            n_rows = n_rows - 1,
+            n_scored = n_scored - ({_score(row)} IS NOT NULL),
+            score_sum = score_sum - COALESCE({_score(row)}, 0)
+        WHERE dataset_id = {row}.dataset_id AND dimension = '{dimension}'
+            AND value = {expression.format(row=row)};
+        """ for dimension, expression in DIMENSIONS.items()]
+    statements.append(
+        f"DELETE FROM {AGG_TABLE} WHERE dataset_id = {row}.dataset_id AND n_rows <= 0;")
+    return statements
+
+
+def _table_statements():
+    """Statements creating the aggregate table and its triggers if they do not exist."""
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS {AGG_TABLE} (
+            dataset_id INTEGER NOT NULL,
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            n_rows INTEGER NOT NULL,
+            n_scored INTEGER NOT NULL,
+            score_sum REAL NOT NULL,
+            PRIMARY KEY (dataset_id, dimension, value)
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {AGG_TABLE}_insert AFTER INSERT ON rankings_raw BEGIN
+            {''.join(_add_statements('new'))}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {AGG_TABLE}_delete AFTER DELETE ON rankings_raw BEGIN
+            {''.join(_remove_statements('old'))}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {AGG_TABLE}_update AFTER UPDATE ON rankings_raw BEGIN
+            {''.join(_remove_statements('old'))}
+            {''.join(_add_statements('new'))}
+        END
+        """,
+    ]
+
+
+def _rebuild_statements():
+    """Statements recomputing the aggregate table from rankings_raw."""
+    return [
+        f"DELETE FROM {AGG_TABLE}",
+        f"INSERT INTO {AGG_TABLE} (dataset_id, dimension, value, n_rows, n_scored, score_sum) "
+        f"{_recompute_query()}",
+    ]
+
+
+def create_aggregates():
+    """
+    Creates the aggregate table and the triggers that maintain it, then builds it from the
+    rows already in rankings_raw.
+
+    Returns:
+        bool: True if successful, False otherwise.
+    """
+    if not data.sqltransaction(_table_statements() + _rebuild_statements()):
+        logger.error("Failed to create aggregate table %s", AGG_TABLE)
+        return False
+    logger.info("Created aggregate table %s", AGG_TABLE)
+    return True
+
+
+def ensure_aggregates():
+    """
+    Creates and builds the aggregate table if it or one of its triggers is missing.
+
+    Returns:
+        bool: True if the aggregate table is in place, False otherwise.
+    """
+    if not data.ensure_derived_table([AGG_TABLE, *AGG_TRIGGERS],
+                                     _table_statements() + _rebuild_statements()):
+        logger.error("Failed to create aggregate table %s", AGG_TABLE)
+        return False
+    return True
+
+
+def _recompute_query():
+    """A query computing the aggregates from scratch over rankings_raw."""
+    return ' UNION ALL '.join(f"""
+        SELECT r.dataset_id, '{dimension}' AS dimension, {expression.format(row='r')} AS value,
+               COUNT(*) AS n_rows, COUNT({_score('r')}) AS n_scored,
+               COALESCE(SUM({_score('r')}), 0) AS score_sum
+        FROM rankings_raw r
+        WHERE r.dataset_id IS NOT NULL
+        GROUP BY r.dataset_id, value
+        """ for dimension, expression in DIMENSIONS.items())
+
+
+def rebuild_aggregates():
+    """Recomputes the aggregate table from rankings_raw in one transaction."""
+    if not data.sqltransaction(_rebuild_statements()):
+        logger.error("Failed to rebuild aggregate table %s", AGG_TABLE)
+        return False
+    logger.info("Rebuilt aggregate table %s", AGG_TABLE)
+    return True
+
+
+def get_summary(dimension: str, by=('study', 'country', 'year'), **filters) -> pd.DataFrame:
+    """
+    Reads a summary from the aggregate table.
+
+    Arguments:
+        dimension (str) -- one of DIMENSIONS, 'all' gives the ranking sizes
+        by (list) -- dataset attributes to group by, from SUMMARY_GROUPS
+        filters -- dataset attributes to filter on, e.g. study='dei', year=2024
+
+    Returns:
+        A dataframe with the 'by' columns, the dimension value (except for 'all'), the number
+        of companies and their mean score
+    """
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown dimension '{dimension}'")
+    unknown = [column for column in [*by, *filters] if column not in SUMMARY_GROUPS]
+    if unknown:
+        raise ValueError(f"Cannot group or filter by {unknown}")
+
+    group_columns = [f"d.{column}" for column in by]
+    select_columns = list(group_columns)
+    if dimension != 'all':
+        value = "CAST(NULLIF(a.value, '') AS INTEGER)" \
+            if dimension in INTEGER_DIMENSIONS else "a.value"
+        group_columns.append(value)
+        select_columns.append(f"{value} AS {dimension}")
+    where = ''.join(f" AND d.{column} = ?" for column in filters)
+    group_by = f"GROUP BY {', '.join(group_columns)} ORDER BY {', '.join(group_columns)}" \
+        if group_columns else ''
+
+    query = f"""
+    SELECT {''.join(column + ', ' for column in select_columns)}
+           SUM(a.n_rows) AS companies,
+           SUM(a.score_sum) / NULLIF(SUM(a.n_scored), 0) AS mean_score
+    FROM {AGG_TABLE} a
+    JOIN datasets d ON d.dataset_id = a.dataset_id
+    WHERE a.dimension = ?{where}
+    {group_by}
+    """
+    return data.sqlselect(query, (dimension, *filters.values()))
+
+
+def ranking_sizes(**filters) -> pd.DataFrame:
+    """Returns the number of ranked companies per study, country and year."""
+    return get_summary('all', **filters)
+
+
+def score_distribution(**filters) -> pd.DataFrame:
+    """Returns the number of companies per score band, study, country and year."""
+    return get_summary('score_band', **filters)
+
+
+def check_aggregates() -> pd.DataFrame:
+    """
+    Compares the aggregate table with a full recompute from rankings_raw.
+
+    Returns:
+        A dataframe of the rows that differ (empty if the aggregates are consistent)
+    """
+    keys = ['dataset_id', 'dimension', 'value']
+    stored = data.sqlselect(f"SELECT * FROM {AGG_TABLE}")
+    expected = data.sqlselect(_recompute_query())
+    compared = stored.merge(expected, on=keys, how='outer', suffixes=('', '_expected'),
+                            indicator=True)
+
+    mismatched = compared['_merge'] != 'both'
+    for column in ['n_rows', 'n_scored']:
+        mismatched |= compared[column] != compared[f'{column}_expected']
+    mismatched |= (compared['score_sum'] - compared['score_sum_expected']).abs() > 1e-6
+
+    mismatches = compared[mismatched]
+    if mismatches.empty:
+        logger.info("Aggregate table %s is consistent with rankings_raw", AGG_TABLE)
+    else:
+        logger.warning("Aggregate table %s has %d inconsistent rows", AGG_TABLE, len(mismatches))
+    return mismatches
@@ -3,42 +3,75 @@ This module provides simplified functionality for quick analysis of rankings dat
 
 Functions:
     get_rankings_data: loads data from one or more CSV files in the cwd
+    iter_rankings_chunks: streams a snapshot or the ranking CSVs in fixed-size chunks
+    aggregate_rankings: computes group-by aggregations chunk by chunk
+    build_snapshot_cache: writes a memory-mappable binary cache of a snapshot
+    get_compact_rankings_data: loads the rankings as compact rows plus a per-dataset table
+    benchmark_memory: compares the memory footprint of the plain and compact representations
+
+The shared categories of the compact representation are kept in data/categories.json. It is
+local state built up by loading rankings, not part of the repository.
 """
+import glob
+import json
 import os
+import time
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
-from dei_rankings import logging_config
+from dei_rankings import logging_config, delta
 
 logger = logging_config.logger
 
-def get_rankings_data(file_pattern: str = '.csv') -> pd.DataFrame:
+DATA_FOLDER = os.path.join('..', 'data')
+CACHE_FOLDER = os.path.join(DATA_FOLDER, 'cache')
+CHUNK_ROWS = 100_000
+
+CATEGORICAL_COLUMNS = ['study', 'country', 'filename', 'chart_title']
+
+# columns of the compact representation that are dictionary-encoded with the shared categories
+# from CATEGORIES_PATH; new values are appended there so existing codes never change. A lock
+# older than the timeout was left by a process that died and is removed.
+CATEGORIES_PATH = os.path.join(DATA_FOLDER, 'categories.json')
+COMPACT_CATEGORICAL_COLUMNS = CATEGORICAL_COLUMNS + ['industry', 'state', 'employees']
+CATEGORIES_LOCK_TIMEOUT_SECONDS = 30
+
+# dtypes of the combined rankings, as in the data/all_*.csv snapshots
+RANKINGS_DTYPES = {
+    'rank': 'Int32', 'company': str, 'founded': 'float32', 'employees': str,
+    'score': 'float64', 'ceo': str, 'state': str, 'hq': str, 'industry': str,
+    'study': 'category', 'country': 'category', 'year': 'Int16',
+    'filename': 'category', 'chart_title': 'category',
+}
+
+# numpy dtypes of the numeric columns in the binary cache, integers with gaps are stored as float
+CACHE_NUMERIC_DTYPES = {'rank': 'int32', 'founded': 'float32', 'score': 'float64', 'year': 'int16'}
+
+# how partial results of each aggregation are combined across chunks
+CHUNK_COMBINERS = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+
+def iter_ranking_files(file_pattern: str = '.csv'):
     """
-    
-    Loads data from one or more CSV files in the cwd
+    Yields the current view of each ranking CSV in the data folder with the study, country,
+    year, filename and chart_title columns added.
 
     Arguments:
         file_pattern (str) -- optional str which should exist in the file name (e.g. usa)
-
-    Returns:
-        A dataframe containing the rankings from one or more files
-
     """
 
     # Load Sheet1 from datasets.xlsx file from the root folder
     df_datasets = pd.read_excel(r'..\data\datasets.xlsx', sheet_name='datasets')
 
-    # a list to hold the dataframes from each file
-    dfs = []
-
     for f in os.listdir("..\\data"):
         if f.startswith('r_statista') and (file_pattern in f) and f.endswith('.csv'):
 
-            df = pd.read_csv('..\\data\\' + f)
+            df = delta.read_current('..\\data\\' + f)
 
-            # populate the study country and year columns from the filename
-            df[['study','country','year']] = [f.split('_')[t] for t in [2,3,4]]
+            # populate the study and country columns from the filename
+            df[['study','country']] = [f.split('_')[t] for t in [2,3]]
 
-            # remove the .csv suffix and populate a filename column
-            df['year'] = df.year.str.replace('.csv', '', regex=True).astype(int)
+            # the year is the last part of the filename before the .csv suffix
+            df['year'] = int(os.path.splitext(f)[0].split('_')[4])
             df['filename'] = f
 
             chart_title = df_datasets[df_datasets.filename == 'data\\' + f].chart_title.unique()[0]
@@ -48,7 +81,23 @@ def get_rankings_data(file_pattern: str = '.csv') -> pd.DataFrame:
             # get the chart_title column from df_datasets for the row where filename == f
             df['chart_title'] = chart_title
 
-            dfs.append(df)
+            yield df
+
+def get_rankings_data(file_pattern: str = '.csv') -> pd.DataFrame:
+    """
+    
+    Loads data from one or more CSV files in the cwd
+
+    Arguments:
+        file_pattern (str) -- optional str which should exist in the file name (e.g. usa)
+
+    Returns:
+        A dataframe containing the rankings from one or more files
+
+    """
+
+    # a list to hold the dataframes from each file
+    dfs = list(iter_ranking_files(file_pattern))
 
     # combine the list of dfs into a single df
     df_result = pd.concat(dfs)
@@ -79,3 +128,422 @@ def get_source_data(country: str, study: str, year: int) -> pd.DataFrame:
                             (df_datasets.year == year)]
 
     return df_result
+
+
+def latest_snapshot() -> str:
+    """Returns the path of the most recent data/all_*.csv snapshot."""
+    snapshots = sorted(glob.glob(os.path.join(DATA_FOLDER, 'all_*.csv')))
+    if not snapshots:
+        raise FileNotFoundError(f"No snapshot found in {DATA_FOLDER}")
+    return snapshots[-1]
+
+
+def _cache_folder(path: str) -> str:
+    return os.path.join(CACHE_FOLDER, os.path.splitext(os.path.basename(path))[0])
+
+
+def _source_stamp(path: str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_snapshot_cache(path: str = None) -> str:
+    """
+    Parses a snapshot and writes each column as a .npy file that later reads can memory-map.
+    Text columns are stored as integer codes plus their sorted categories. The snapshot is
+    read twice, chunk by chunk, so memory stays bounded while the cache is built.
+
+    Arguments:
+        path (str) -- the snapshot CSV, the latest snapshot by default
+
+    Returns:
+        The folder of the cache
+    """
+    path = path or latest_snapshot()
+    folder = _cache_folder(path)
+    os.makedirs(folder, exist_ok=True)
+    text_columns = [column for column, dtype in RANKINGS_DTYPES.items()
+                    if dtype in (str, 'category')]
+
+    # first pass: the number of rows, the categories and which integer columns have gaps
+    rows, categories, has_na = 0, {column: set() for column in text_columns}, set()
+    for chunk in iter_rankings_chunks(path):
+        rows += len(chunk)
+        for column in text_columns:
+            categories[column].update(chunk[column].dropna().unique())
+        has_na.update(column for column in CACHE_NUMERIC_DTYPES if chunk[column].isna().any())
+    categories = {column: sorted(values) for column, values in categories.items()}
+
+    # second pass: write the columns into memory-mapped arrays
+    arrays = {}
+    for column in text_columns:
+        arrays[column] = np.lib.format.open_memmap(
+            os.path.join(folder, f'{column}.npy'), mode='w+', dtype=np.int32, shape=(rows,))
+    for column, dtype in CACHE_NUMERIC_DTYPES.items():
+        arrays[column] = np.lib.format.open_memmap(
+            os.path.join(folder, f'{column}.npy'), mode='w+', shape=(rows,),
+            dtype=np.float64 if column in has_na else dtype)
+
+    start = 0
+    for chunk in iter_rankings_chunks(path):
+        end = start + len(chunk)
+        for column in text_columns:
+            arrays[column][start:end] = pd.Categorical(
+                chunk[column], categories=categories[column]).codes
+        for column in CACHE_NUMERIC_DTYPES:
+            arrays[column][start:end] = chunk[column].to_numpy(
+                dtype=arrays[column].dtype, na_value=np.nan)
+        start = end
+    for array in arrays.values():
+        array.flush()
+
+    meta = {'source': _source_stamp(path), 'rows': rows, 'columns': {
+        column: {'categories': categories.get(column)}
+        for column in RANKINGS_DTYPES if column in arrays}}
+    with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    logger.info("Cached %s rows of %s in %s", rows, path, folder)
+    return folder
+
+
+def _open_snapshot_cache(path: str, columns=None):
+    """Returns the metadata and memory-mapped columns of a snapshot cache, or None if stale."""
+    folder = _cache_folder(path)
+    try:
+        with open(os.path.join(folder, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta['source'] != _source_stamp(path):
+        return None
+    columns = columns or list(meta['columns'])
+    arrays = {column: np.load(os.path.join(folder, f'{column}.npy'), mmap_mode='r')
+              for column in columns}
+    return meta, arrays
+
+
+def _iter_cache_chunks(meta, arrays, chunksize):
+    dtypes = {column: pd.CategoricalDtype(info['categories'])
+              for column, info in meta['columns'].items() if info['categories'] is not None}
+    for start in range(0, meta['rows'], chunksize):
+        chunk = {}
+        for column, array in arrays.items():
+            values = np.asarray(array[start:start + chunksize])
+            chunk[column] = pd.Categorical.from_codes(values, dtype=dtypes[column]) \
+                if column in dtypes else values
+        yield pd.DataFrame(chunk)
+
+
+def iter_rankings_chunks(path: str = None, chunksize: int = CHUNK_ROWS, columns=None,
+                         file_pattern: str = '.csv', use_cache: bool = False):
+    """
+    Iterates the combined rankings in chunks of at most chunksize rows, so memory stays
+    bounded however large the history grows.
+
+    Arguments:
+        path (str) -- a snapshot CSV to stream. Without a path the ranking CSVs are streamed.
+        chunksize (int) -- the maximum number of rows in a chunk
+        columns (list) -- optional columns to read
+        file_pattern (str) -- filters the ranking CSVs when no path is given (e.g. usa)
+        use_cache (bool) -- read from the binary cache of the snapshot, building it if needed.
+            Text columns are then categorical. Requires a path.
+
+    Yields:
+        Dataframes with RANKINGS_DTYPES
+
+    Raises:
+        ValueError: if use_cache is set without a path; the ranking CSVs have no cache
+    """
+    if use_cache and path is None:
+        raise ValueError("use_cache needs the path of a snapshot CSV")
+
+    if path is None:
+        # categories differ between files, so they are encoded per chunk
+        dtypes = {column: dtype for column, dtype in RANKINGS_DTYPES.items()
+                  if columns is None or column in columns}
+        categorical = [column for column, dtype in dtypes.items() if dtype == 'category']
+        plain = {column: dtype for column, dtype in dtypes.items()
+                 if dtype not in ('category', str)}
+        text = [column for column, dtype in dtypes.items() if dtype is str]
+
+        buffer, rows = [], 0
+        for df in iter_ranking_files(file_pattern):
+            df = (df[columns] if columns else df).astype(plain)
+            # astype(str) would turn missing values into 'nan', so only present values are cast
+            for column in text:
+                df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+            buffer.append(df)
+            rows += len(df)
+            if rows < chunksize:
+                continue
+            combined = pd.concat(buffer, ignore_index=True)
+            full_rows = rows - rows % chunksize
+            for start in range(0, full_rows, chunksize):
+                yield combined.iloc[start:start + chunksize].astype(
+                    {column: 'category' for column in categorical})
+            buffer, rows = [combined.iloc[full_rows:]], rows % chunksize
+        if rows:
+            yield pd.concat(buffer, ignore_index=True).astype(
+                {column: 'category' for column in categorical})
+        return
+
+    if use_cache:
+        cache = _open_snapshot_cache(path, columns)
+        if cache is None:
+            build_snapshot_cache(path)
+            cache = _open_snapshot_cache(path, columns)
+        yield from _iter_cache_chunks(*cache, chunksize)
+        return
+
+    dtypes = {column: dtype for column, dtype in RANKINGS_DTYPES.items()
+              if columns is None or column in columns}
+    yield from pd.read_csv(path, chunksize=chunksize, usecols=columns, dtype=dtypes)
+
+
+def aggregate_rankings(by, agg: dict, path: str = None, chunksize: int = CHUNK_ROWS,
+                       file_pattern: str = '.csv', use_cache: bool = False) -> pd.DataFrame:
+    """
+    Computes a group-by aggregation chunk by chunk without loading the whole history.
+
+    Arguments:
+        by (str or list) -- the columns to group by, e.g. ['study', 'year']
+        agg (dict) -- the aggregations per column from sum, count, min, max and mean,
+            e.g. {'score': ['mean', 'max'], 'company': ['count']}
+        path, chunksize, file_pattern, use_cache -- as in iter_rankings_chunks
+
+    Returns:
+        A dataframe indexed by the group columns with a <column>_<function> column for each
+        aggregation
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    partial_agg = {}
+    for column, functions in agg.items():
+        for function in functions:
+            if function == 'mean':
+                partial_agg.setdefault(column, set()).update(['sum', 'count'])
+            elif function in CHUNK_COMBINERS:
+                partial_agg.setdefault(column, set()).add(function)
+            else:
+                raise ValueError(f"Unsupported aggregation '{function}'")
+    partial_agg = {column: sorted(functions) for column, functions in partial_agg.items()}
+
+    # partial results are folded into a running total, so memory grows with the number of
+    # groups rather than the number of chunks
+    combined = None
+    columns = list(dict.fromkeys(by + list(agg)))
+    for chunk in iter_rankings_chunks(path, chunksize=chunksize, columns=columns,
+                                      file_pattern=file_pattern, use_cache=use_cache):
+        partial = chunk.groupby(by, observed=True).agg(partial_agg)
+        if combined is not None:
+            partial = pd.concat([combined, partial])
+            partial = partial.groupby(level=list(range(len(by))), observed=True).agg(
+                {key: CHUNK_COMBINERS[key[1]] for key in partial.columns})
+        combined = partial
+
+    if combined is None:
+        return pd.DataFrame()
+
+    result = pd.DataFrame(index=combined.index)
+    for column, functions in agg.items():
+        for function in functions:
+            if function == 'mean':
+                result[f'{column}_mean'] = combined[(column, 'sum')] / combined[(column, 'count')]
+            else:
+                result[f'{column}_{function}'] = combined[(column, function)]
+    return result
+
+
+def load_category_registry(path: str = CATEGORIES_PATH) -> dict:
+    """Returns the shared categories of each column in COMPACT_CATEGORICAL_COLUMNS."""
+    registry = {column: [] for column in COMPACT_CATEGORICAL_COLUMNS}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            registry.update(json.load(f))
+    return registry
+
+
+def save_category_registry(registry: dict, path: str = CATEGORIES_PATH):
+    """Writes the shared categories, replacing the file in one step."""
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(registry, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def _category_registry_lock(path: str = CATEGORIES_PATH):
+    """
+    Holds a lock file next to the registry so only one process updates it at a time. The
+    lock records the PID of its owner.
+    """
+    lock_path = path + '.lock'
+    deadline = time.monotonic() + CATEGORIES_LOCK_TIMEOUT_SECONDS
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            break
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(lock_path)
+            except FileNotFoundError:
+                continue
+            if age > CATEGORIES_LOCK_TIMEOUT_SECONDS:
+                try:
+                    with open(lock_path, encoding='utf-8') as f:
+                        owner = f.read() or 'unknown'
+                    logger.warning("Removing stale lock %s of process %s", lock_path, owner)
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not lock {path}; remove {lock_path} if no other "
+                                   "process is updating it") from None
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+def merge_category_registry(new_values: dict, path: str = CATEGORIES_PATH) -> dict:
+    """
+    Appends values to the shared categories. The registry is re-read under a lock, so values
+    added by another process in the meantime are kept and keep their codes.
+
+    Arguments:
+        new_values (dict) -- the values to add for each column, in order
+
+    Returns:
+        dict -- the registry as written
+    """
+    with _category_registry_lock(path):
+        registry = load_category_registry(path)
+        changed = False
+        for column, values in new_values.items():
+            known = set(registry.setdefault(column, []))
+            for value in values:
+                if value not in known:
+                    registry[column].append(value)
+                    known.add(value)
+                    changed = True
+        if changed:
+            save_category_registry(registry, path)
+    return registry
+
+
+def _encode(series: pd.Series, categories: list) -> np.ndarray:
+    """Returns the codes of series in categories, appending values not seen before."""
+    values = series.astype(str).where(series.notna())
+    categories.extend(sorted(set(values.dropna()) - set(categories)))
+    return pd.Categorical(values, categories=categories).codes
+
+
+def _downcast(series: pd.Series) -> pd.Series:
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series):
+        # floats are only narrowed when every value survives the round trip, e.g. founded
+        # years but not scores with decimals
+        downcast = pd.to_numeric(series, downcast='float')
+        return downcast if downcast.astype(series.dtype).equals(series) else series
+    return series
+
+
+def get_compact_rankings_data(file_pattern: str = '.csv'):
+    """
+    Loads the same rankings as get_rankings_data in a compact form. The filename, chart_title,
+    study, country and year are kept once per dataset in a separate table joined by
+    dataset_key; the industry, state and employees columns are categoricals with the shared
+    category order from CATEGORIES_PATH; numeric columns are downcast where no value changes.
+
+    Arguments:
+        file_pattern (str) -- optional str which should exist in the file name (e.g. usa)
+
+    Returns:
+        tuple -- (rankings, datasets) where datasets is indexed by dataset_key. Use
+        expand_rankings to get the frame returned by get_rankings_data.
+    """
+    registry = load_category_registry()
+    sizes = {column: len(values) for column, values in registry.items()}
+
+    rankings, datasets = [], []
+    for df in iter_ranking_files(file_pattern):
+        meta = {column: _encode(df[column].iloc[:1], registry[column])[0]
+                for column in CATEGORICAL_COLUMNS}
+        meta['year'] = df['year'].iloc[0]
+        datasets.append(meta)
+
+        df = df.drop(columns=CATEGORICAL_COLUMNS + ['year'])
+        for column in COMPACT_CATEGORICAL_COLUMNS:
+            if column in df.columns:
+                df[column] = _encode(df[column], registry[column])
+        df['dataset_key'] = meta['filename']
+        rankings.append(df)
+
+    df_datasets = pd.DataFrame(datasets)
+    df_rankings = pd.concat(rankings, ignore_index=True)
+
+    # values seen for the first time were given codes after the ones loaded above; another
+    # process may have added values since, so they are merged and their codes remapped
+    added = {column: values[sizes[column]:] for column, values in registry.items()
+             if len(values) > sizes[column]}
+    if added:
+        local = registry
+        registry = merge_category_registry(added)
+        for column in added:
+            positions = {value: code for code, value in enumerate(registry[column])}
+            lookup = np.array([positions[value] for value in local[column]])
+
+            def remap(codes):
+                codes = np.asarray(codes)
+                return np.where(codes >= 0, lookup[codes], -1)
+
+            if column in df_datasets.columns:
+                df_datasets[column] = remap(df_datasets[column])
+            if column in df_rankings.columns:
+                df_rankings[column] = remap(df_rankings[column])
+            if column == 'filename':
+                df_rankings['dataset_key'] = remap(df_rankings['dataset_key'])
+
+    def decode(df, columns):
+        # codes stay valid because the registry only ever grows
+        for column in columns:
+            df[column] = pd.Categorical.from_codes(df[column], categories=registry[column])
+        return df
+
+    df_datasets = decode(df_datasets, CATEGORICAL_COLUMNS)
+    df_datasets['year'] = pd.to_numeric(df_datasets['year'], downcast='integer')
+    df_datasets.index = pd.Index(df_datasets.filename.cat.codes, name='dataset_key')
+
+    df_rankings = decode(df_rankings, [column for column in COMPACT_CATEGORICAL_COLUMNS
+                                       if column in df_rankings.columns])
+    df_rankings = df_rankings.apply(_downcast)
+
+    logger.info("Found %s rows in %s files.", len(df_rankings), len(df_datasets))
+    return df_rankings, df_datasets
+
+
+def expand_rankings(rankings: pd.DataFrame, datasets: pd.DataFrame) -> pd.DataFrame:
+    """Joins the compact rankings with their datasets into one frame per ranking row."""
+    columns = [column for column in rankings.columns if column != 'dataset_key']
+    return rankings.join(datasets, on='dataset_key')[
+        columns + ['study', 'country', 'year', 'filename', 'chart_title']]
+
+
+def benchmark_memory(file_pattern: str = '.csv') -> dict:
+    """
+    Measures the deep memory footprint of get_rankings_data against the compact
+    representation from get_compact_rankings_data for the same files.
+
+    Returns:
+        dict -- bytes before and after and the ratio between them
+    """
+    before = get_rankings_data(file_pattern).memory_usage(deep=True).sum()
+    rankings, datasets = get_compact_rankings_data(file_pattern)
+    after = rankings.memory_usage(deep=True).sum() + datasets.memory_usage(deep=True).sum()
+    result = {'before': int(before), 'after': int(after), 'ratio': float(before / after)}
+    logger.info("Memory footprint: %.1f MB before, %.1f MB compact (%.1fx smaller)",
+                before / 1e6, after / 1e6, result['ratio'])
+    return result
@@ -63,12 +63,12 @@ def sqlddl(cmd):
         if conn:
             conn.close()
 
-def sqlselect(cmd):
+def sqlselect(cmd, params=None):
     """Executes a SELECT command on the SQLite database and returns the result as a DataFrame."""
     conn = None
     try:
         conn = sqlite3.connect(SQLITE_PATH)
-        df = pd.read_sql_query(cmd, conn)
+        df = pd.read_sql_query(cmd, conn, params=params)
         return df
     except sqlite3.OperationalError as e:
         print(f"SQL Error: {e}")
@@ -80,6 +80,72 @@ def sqlselect(cmd):
         if conn:
             conn.close()
 
+def sqltransaction(statements, unless_exist=None):
+    """
+    Executes several SQL commands in one transaction, so either all of them take effect or
+    none do.
+
+    Arguments:
+        statements (list): The SQL commands to execute, in order.
+        unless_exist (list, optional): Names of tables and triggers; if all of them already
+            exist, nothing is executed. They are checked inside the transaction, so of two
+            connections creating the same objects only the first one does the work.
+
+    Returns:
+        bool: True if the operation was successful, False otherwise.
+    """
+    conn = None
+    try:
+        # a long build in another connection is waited for rather than failed on
+        conn = sqlite3.connect(SQLITE_PATH, timeout=60, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        if unless_exist:
+            existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+            if all(name in existing for name in unless_exist):
+                conn.execute("COMMIT")
+                return True
+        for cmd in statements:
+            conn.execute(cmd)
+        conn.execute("COMMIT")
+        return True
+    except sqlite3.DatabaseError as e:
+        if conn and conn.in_transaction:
+            conn.execute("ROLLBACK")
+        print(f"Database Error: {e}")
+        return False
+    except Exception as e:
+        if conn and conn.in_transaction:
+            conn.execute("ROLLBACK")
+        print(f"Unexpected Error: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def schema_objects_exist(names):
+    """Returns True if all the named tables, views, indexes and triggers exist."""
+    df = sqlselect("SELECT name FROM sqlite_master")
+    return df is not None and set(names) <= set(df['name'])
+
+def ensure_derived_table(names, statements):
+    """
+    Creates a table derived from rankings_raw, the triggers that keep it in sync and fills
+    it, unless the table and all its triggers already exist.
+
+    Everything runs in one transaction: a failed build leaves neither a half-built table nor
+    triggers writing to a missing table behind, so ingests keep working without it.
+
+    Arguments:
+        names (list): The table and trigger names the statements create.
+        statements (list): The CREATE statements followed by the statements filling the table.
+
+    Returns:
+        bool: True if the table and its triggers exist, False otherwise.
+    """
+    if schema_objects_exist(names):
+        return True
+    return sqltransaction(statements, unless_exist=names)
+
 def sqllookup(lookup_table, singular):
     """Creates a lookup table for a specified column in the datasets table."""
     try:
@@ -128,31 +194,180 @@ def sqllookup(lookup_table, singular):
     except Exception as e:
         print(f"Error in sqllookup: {e}")
 
-def refresh_dataframes():
+TABLE_IDS = {
+    "datasets": "dataset_id",
+    "countries": "country_id",
+    "studies": "study_id",
+    "rankings_raw": "rankings_raw_id",
+}
+
+# dtypes applied to cached tables where the column exists
+TABLE_DTYPES = {
+    "datasets": {"country": "category", "study": "category", "link_valid": "Int8",
+                 "country_id": "Int32", "study_id": "Int32"},
+    "countries": {},
+    "studies": {},
+    "rankings_raw": {"dataset_id": "Int32", "employees": "category", "state": "category",
+                     "industry": "category"},
+}
+
+
+def ensure_change_counters(tables=None):
     """
-    Refreshes dataframes by querying specified tables from the SQLite database.
-    Returns a dictionary of table names and their corresponding dataframes.
+    Creates the table_versions table and the triggers that bump a table's version whenever
+    one of its rows is inserted, updated or deleted.
     """
-    dataframes = {}
+    tables = tables or list(TABLE_IDS)
+    sqlddl("CREATE TABLE IF NOT EXISTS table_versions "
+           "(table_name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    for table in tables:
+        sqldml("INSERT OR IGNORE INTO table_versions (table_name, version) VALUES (?, 0)",
+               (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            sqlddl(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}';
+            END
+            """)
+
 
-    table_ids = {
-        "datasets": "dataset_id",
-        "countries": "country_id",
-        "studies": "study_id",
-        "rankings_raw": "rankings_raw_id",
-    }
+class TableCache:
+    """
+    Lazily loads tables from the SQLite database and keeps them until their contents change.
 
-    tables = list(table_ids.keys())
+    PRAGMA data_version tells the cache whether anything was committed since the last check,
+    and the per-table counters in table_versions tell it which tables need re-querying.
+    A change of PRAGMA schema_version (e.g. sqllookup dropping and re-creating a table, which
+    also drops its triggers) clears the cache and re-creates the change counters.
+    Returned DataFrames are shared between callers and should be treated as read-only.
+    """
 
-    for table in tables:
+    def __init__(self, table_ids=None, dtypes=None):
+        self.table_ids = table_ids or TABLE_IDS
+        self.dtypes = TABLE_DTYPES if dtypes is None else dtypes
+        self._conn = None
+        self._data_version = None
+        self._schema_version = None
+        self._versions = None
+        self._frames = {}
+        self._loaded_versions = {}
+
+    def _connection(self):
+        if self._conn is None:
+            ensure_change_counters(list(self.table_ids))
+            self._conn = sqlite3.connect(SQLITE_PATH, check_same_thread=False)
+        return self._conn
+
+    def _table_versions(self):
         try:
-            query = f"SELECT * FROM {table}"
-            df = sqlselect(query)
-            if df is not None:
-                dataframes[table] = df.set_index(table_ids[table])
-                print(f"Successfully retrieved table '{table}' with {len(df)} rows.")
-            else:
-                print(f"Warning: Table '{table}' could not be retrieved.")
+            rows = self._connection().execute(
+                "SELECT table_name, version FROM table_versions").fetchall()
+            return dict(rows)
+        except sqlite3.DatabaseError:
+            return None
+
+    def _check_schema(self):
+        conn = self._connection()
+        schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        if schema_version == self._schema_version:
+            return
+        if self._schema_version is not None:
+            # tables may have been re-created without their triggers
+            self.invalidate()
+            ensure_change_counters(list(self.table_ids))
+            schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        self._schema_version = schema_version
+        self._data_version = None
+
+    def _check_changes(self):
+        self._check_schema()
+        data_version = self._connection().execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        self._versions = self._table_versions()
+        for key in list(self._frames):
+            # without change counters any commit invalidates everything
+            if self._versions is None or \
+                    self._versions.get(key[0]) != self._loaded_versions.get(key):
+                del self._frames[key]
+
+    def _load(self, table, columns):
+        id_column = self.table_ids[table]
+        select = "*" if columns is None else ", ".join([id_column, *columns])
+        df = pd.read_sql_query(f"SELECT {select} FROM {table}", self._connection())
+        for column, dtype in self.dtypes.get(table, {}).items():
+            if column in df.columns:
+                try:
+                    df[column] = df[column].astype(dtype)
+                except (TypeError, ValueError) as e:
+                    print(f"Warning: could not convert {table}.{column} to {dtype}: {e}")
+        return df.set_index(id_column)
+
+    def get(self, table, columns=None):
+        """
+        Returns the table as a DataFrame indexed by its id column, querying it only on first
+        access or after its contents changed.
+
+        Arguments:
+            table (str): One of the tables in table_ids.
+            columns (list, optional): Columns to project. The id column is always included.
+        """
+        if table not in self.table_ids:
+            raise KeyError(f"Unknown table '{table}'")
+        self._check_changes()
+        key = (table, tuple(columns) if columns else None)
+        if key not in self._frames:
+            self._frames[key] = self._load(table, key[1])
+            self._loaded_versions[key] = (self._versions or {}).get(table)
+            print(f"Successfully retrieved table '{table}' with {len(self._frames[key])} rows.")
+        return self._frames[key]
+
+    def invalidate(self, table=None):
+        """Drops cached frames for table, or for every table if none is given."""
+        for key in list(self._frames):
+            if table is None or key[0] == table:
+                del self._frames[key]
+
+    def close(self):
+        """Closes the connection and clears the cache."""
+        self.invalidate()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._data_version = None
+        self._schema_version = None
+
+
+# refresh_dataframes returns the columns as stored unless typed frames are asked for
+table_cache = TableCache(dtypes={})
+typed_table_cache = TableCache()
+
+
+def _copy_on_write():
+    mode = pd.options.mode.copy_on_write if hasattr(pd.options.mode, 'copy_on_write') else None
+    return int(pd.__version__.split('.')[0]) >= 3 or mode is True
+
+
+def refresh_dataframes(cache=None, typed=False):
+    """
+    Refreshes dataframes from the SQLite database through a TableCache, so only tables whose
+    contents changed since the last call are queried again.
+    Returns a dictionary of table names and their corresponding dataframes.
+
+    Each caller gets its own copy, so editing it does not change the cached frame. With
+    typed=True the frames use the TABLE_DTYPES (e.g. categorical country and study).
+    """
+    cache = cache or (typed_table_cache if typed else table_cache)
+    # a shallow copy is enough under copy-on-write, otherwise the data has to be copied
+    deep = not _copy_on_write()
+    dataframes = {}
+
+    for table in cache.table_ids:
+        try:
+            dataframes[table] = cache.get(table).copy(deep=deep)
         except Exception as e:
             print(f"Error while getting table '{table}': {e}")
 
@@ -164,6 +379,45 @@ def refresh_dataframes():
     return dataframes
 
 
+def ingest_rankings(dataset_id: int, df: pd.DataFrame):
+    """
+    Replaces the rows of a dataset in rankings_raw with the rows of a cleaned ranking.
+    Columns of df that rankings_raw does not have are ignored. Triggers on rankings_raw keep
+    the search index and the aggregate tables up to date.
+
+    Arguments:
+        dataset_id (int): The dataset the ranking belongs to.
+        df (DataFrame): The cleaned ranking, e.g. from delta.read_current.
+
+    Returns:
+        bool: True if the rows were ingested successfully, False otherwise.
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(SQLITE_PATH)
+        table_columns = [row[1] for row in conn.execute("PRAGMA table_info(rankings_raw)")]
+        columns = [column for column in df.columns if column in table_columns]
+        values = df[columns].astype(object).where(df[columns].notna(), None)
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        with conn:
+            conn.execute("DELETE FROM rankings_raw WHERE dataset_id = ?", (dataset_id,))
+            conn.executemany(
+                f"INSERT INTO rankings_raw (dataset_id, {', '.join(columns)}) "
+                f"VALUES ({placeholders})",
+                [(dataset_id, *row) for row in values.itertuples(index=False)]
+            )
+        return True
+    except sqlite3.DatabaseError as e:
+        print(f"Database Error: {e}")
+        return False
+    except Exception as e:
+        print(f"Unexpected Error: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+
 # function to insert a row to either study_map or country_map
 def insert_new_mapping(data_dict: dict, table_name: str):
     """
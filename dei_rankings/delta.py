@@ -0,0 +1,216 @@
+"""
+This module stores re-scraped rankings as a base CSV plus a log of row-level changes.
+
+A ranking CSV is written once as the base. When it is scraped again, each cleaned row is
+hashed by its (rank, company) key and compared with the current view; only inserted, updated
+and removed rows are appended to the delta log in the deltas folder next to the base file.
+Some rankings repeat a (rank, company) pair, so each row is identified by the pair plus its
+occurrence, the number of earlier rows with the same pair.
+
+Functions:
+    diff_rankings: compares two versions of a ranking and returns the changed rows
+    write_rankings: writes a ranking as a base file or appends its changes to the delta log
+    read_current: reconstructs the current view of a ranking from base plus deltas
+    current_view: the current view as strings with the key of each row in the delta log
+    compact: folds the delta log into the base file
+"""
+import io
+import os
+from datetime import datetime
+import pandas as pd
+from dei_rankings import logging_config
+
+logger = logging_config.logger
+
+KEY_COLUMNS = ['rank', 'company']
+OCCURRENCE_COLUMN = 'occurrence'
+ROW_KEY_COLUMNS = KEY_COLUMNS + [OCCURRENCE_COLUMN]
+DELTA_FOLDER = 'deltas'
+
+
+def get_delta_path(filename: str) -> str:
+    """Returns the path of the delta log for a ranking CSV."""
+    folder, name = os.path.split(filename)
+    return os.path.join(folder, DELTA_FOLDER, name)
+
+
+def with_occurrence(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns df with an occurrence column counting earlier rows with the same key."""
+    keys = df[KEY_COLUMNS].fillna('').astype(str)
+    return df.assign(**{OCCURRENCE_COLUMN: keys.groupby(KEY_COLUMNS).cumcount()})
+
+
+def row_hashes(df: pd.DataFrame) -> pd.Series:
+    """
+    Returns a hash of the non-key columns of each row, indexed by (rank, company, occurrence).
+    df must have the occurrence column from with_occurrence.
+    """
+    values = df.drop(columns=ROW_KEY_COLUMNS).fillna('').astype(str)
+    hashes = pd.util.hash_pandas_object(values, index=False)
+    keys = df[ROW_KEY_COLUMNS].fillna('').astype(str)
+    hashes.index = pd.MultiIndex.from_frame(keys)
+    return hashes
+
+
+def _assign_occurrences(old: pd.DataFrame, new: pd.DataFrame) -> pd.Series:
+    """
+    Numbers the rows of new the way old numbers them: the n-th row of a (rank, company) pair
+    in new gets the occurrence of the n-th remaining row of that pair in old, and extra rows
+    get occurrences after the highest one old has used.
+    """
+    old_keys = old[KEY_COLUMNS].fillna('').astype(str)
+    old_nth = old[OCCURRENCE_COLUMN].groupby(
+        [old_keys[column] for column in KEY_COLUMNS]).rank(method='first').astype(int) - 1
+    stored = dict(zip(zip(old_keys['rank'], old_keys['company'], old_nth),
+                      old[OCCURRENCE_COLUMN]))
+    counts = old_keys.value_counts().to_dict()
+    highest = old[OCCURRENCE_COLUMN].groupby(
+        [old_keys[column] for column in KEY_COLUMNS]).max().to_dict()
+
+    new_keys = new[KEY_COLUMNS].fillna('').astype(str)
+    new_nth = new_keys.groupby(KEY_COLUMNS).cumcount()
+    occurrences = []
+    for rank, company, nth in zip(new_keys['rank'], new_keys['company'], new_nth):
+        key = (rank, company)
+        if (rank, company, nth) in stored:
+            occurrences.append(stored[(rank, company, nth)])
+        else:
+            occurrences.append(highest.get(key, -1) + 1 + nth - counts.get(key, 0))
+    return pd.Series(occurrences, index=new.index, dtype=int)
+
+
+def diff_rankings(old: pd.DataFrame, new: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compares two versions of a ranking row by row. Rows are matched by (rank, company) and,
+    where a pair repeats, by the order in which it occurs.
+
+    Arguments:
+        old (DataFrame) -- the current view of the ranking, optionally with the occurrence
+            column from current_view
+        new (DataFrame) -- the freshly cleaned ranking
+
+    Returns:
+        A dataframe of the new rows for inserts and updates and the key of removed rows,
+        with an 'op' column of 'insert', 'update' or 'delete' and the occurrence of the key
+    """
+    old = old.reset_index(drop=True)
+    if OCCURRENCE_COLUMN not in old.columns:
+        old = with_occurrence(old)
+    old[OCCURRENCE_COLUMN] = old[OCCURRENCE_COLUMN].astype(int)
+    new = new.reset_index(drop=True)
+    new = new.assign(**{OCCURRENCE_COLUMN: _assign_occurrences(old, new)})
+    old_hashes = row_hashes(old)
+    new_hashes = row_hashes(new)
+
+    inserted = ~new_hashes.index.isin(old_hashes.index)
+    common = new_hashes.index[~inserted]
+    updated = new_hashes.index.isin(
+        common[new_hashes.loc[common].values != old_hashes.loc[common].values])
+    removed = ~old_hashes.index.isin(new_hashes.index)
+
+    columns = ['op', *new.columns]
+    changes = [
+        new[inserted].assign(op='insert'),
+        new[updated].assign(op='update'),
+        old.loc[removed, ROW_KEY_COLUMNS].assign(op='delete'),
+    ]
+    changes = [df for df in changes if not df.empty]
+    if not changes:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(changes, ignore_index=True).reindex(columns=columns)
+
+
+def current_view(filename: str) -> pd.DataFrame:
+    """
+    Returns the current view of a ranking CSV as strings, with the occurrence column that
+    identifies each row in the delta log.
+    """
+    base = with_occurrence(pd.read_csv(filename, dtype=str))
+    delta_path = get_delta_path(filename)
+    if not os.path.exists(delta_path):
+        return base
+
+    deltas = pd.read_csv(delta_path, dtype=str)
+    if OCCURRENCE_COLUMN not in deltas.columns:
+        deltas[OCCURRENCE_COLUMN] = '0'
+    columns = list(base.columns)
+
+    def keys(df):
+        return pd.MultiIndex.from_frame(
+            df[ROW_KEY_COLUMNS].fillna('').astype(str).astype(object))
+
+    # the latest change of each key wins; base rows no delta mentions are kept as they are
+    latest = deltas.drop_duplicates(subset=ROW_KEY_COLUMNS, keep='last')
+    base_keys, latest_keys = keys(base), keys(latest)
+    mentioned = base_keys.isin(latest_keys)
+    changed = latest[latest.op != 'delete'][columns]
+
+    # changed rows keep the position of the row they replace; new rows go after the last
+    # base row ranked at or above them, as the base file is not always sorted by rank
+    positions = pd.Series(range(len(base)), index=base_keys, dtype=float)
+    base_ranks = pd.to_numeric(base['rank'], errors='coerce')
+    kept = base[~mentioned].assign(_position=positions[~mentioned].values)
+
+    def position(key, rank):
+        if key in positions.index:
+            return positions[key]
+        above = (base_ranks <= rank).to_numpy().nonzero()[0]
+        return above[-1] + 0.5 if len(above) else len(base)
+
+    changed_ranks = pd.to_numeric(changed['rank'], errors='coerce')
+    changed = changed.assign(_position=[position(key, rank) for key, rank
+                                        in zip(keys(changed), changed_ranks)])
+
+    combined = pd.concat([kept, changed], ignore_index=True)
+    combined = combined.sort_values('_position', kind='stable')
+    return combined.drop(columns='_position').reset_index(drop=True)
+
+
+def read_current(filename: str, **kwargs) -> pd.DataFrame:
+    """
+    Returns the current view of a ranking CSV: the base file with its deltas applied.
+
+    Keyword arguments are passed to pd.read_csv. Without a delta log this is a plain read.
+    """
+    if not os.path.exists(get_delta_path(filename)):
+        return pd.read_csv(filename, **kwargs)
+
+    # round-trip through read_csv so column types match a plain read of the base file
+    current = current_view(filename).drop(columns=OCCURRENCE_COLUMN)
+    return pd.read_csv(io.StringIO(current.to_csv(index=False)), **kwargs)
+
+
+def write_rankings(df: pd.DataFrame, filename: str) -> pd.DataFrame:
+    """
+    Writes a cleaned ranking. A new ranking is written as the base file; for an existing one
+    only the changed rows are appended to the delta log with the time of the change.
+
+    Returns:
+        A dataframe of the changes that were written (all rows as inserts for a new file)
+    """
+    if not os.path.exists(filename):
+        df.to_csv(filename, index=False)
+        logger.info("Wrote %d rows to %s", len(df), filename)
+        return df.assign(op='insert')
+
+    changes = diff_rankings(current_view(filename), df.astype(str).where(df.notna()))
+    if changes.empty:
+        logger.info("No changes to %s", filename)
+        return changes
+
+    delta_path = get_delta_path(filename)
+    os.makedirs(os.path.dirname(delta_path), exist_ok=True)
+    changes.insert(0, 'changed_at', datetime.now().isoformat(timespec='seconds'))
+    changes.to_csv(delta_path, mode='a', index=False, header=not os.path.exists(delta_path))
+    logger.info("Logged %s changes to %s", changes.op.value_counts().to_dict(), delta_path)
+    return changes
+
+
+def compact(filename: str):
+    """Rewrites the base file as the current view and removes its delta log."""
+    delta_path = get_delta_path(filename)
+    if not os.path.exists(delta_path):
+        return
+    current_view(filename).drop(columns=OCCURRENCE_COLUMN).to_csv(filename, index=False)
+    os.remove(delta_path)
+    logger.info("Compacted %s", filename)
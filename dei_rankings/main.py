@@ -1,107 +1,209 @@
 """
 This script is used to scrape the data from the rankings page and save it to a file.
+
+The work is split into pipeline stages (discovery -> registration -> scrape -> clean -> ingest
+-> export, with the search index and aggregate tables set up once before any ingest) and only the stages whose inputs changed are run. Use --dry-run to see what would
+run. Known rankings are scraped even if discovery fails, and the export uses whatever ranking
+files exist, so one broken URL does not hold up the rest.
 """
+import argparse
+import json
+import os
 import sys
+from functools import partial
 import pandas as pd
 import dei_rankings.scrape as ws
 import dei_rankings.analysis as ra
 import dei_rankings.utils as utils
+from dei_rankings import aggregates, data, delta, pipeline, search
 
 # sys.path.append('..')
 
 DATASETS_PATH = '.\\data\\datasets.xlsx'
+AVAILABLE_RANKINGS_PATH = data.DATA_FOLDER_PATH / 'available_rankings.json'
+RAW_FOLDER_PATH = data.DATA_FOLDER_PATH / 'raw'
+DATA_JSON_PATH = '..\\data\\data.json'
 
-# Open the Excel file once and create an ExcelFile object
-try:
-    excel_file = pd.ExcelFile(DATASETS_PATH)
-except FileNotFoundError:
-    ws.logger.error("File not found: %s", DATASETS_PATH)
-    sys.exit(1)
-
-tables = ['datasets', 'study_map', 'country_map']
+# the tables and triggers created by the schema stage
+SCHEMA_OBJECTS = [search.FTS_TABLE, *search.FTS_TRIGGERS,
+                  aggregates.AGG_TABLE, *aggregates.AGG_TRIGGERS]
 
-# check that each of the tables exists in the file
-for table in tables:
-    if table not in excel_file.sheet_names:
-        ws.logger.error("Sheet '%s' not found in %s", table, DATASETS_PATH)
-        sys.exit(1)
+# the rankings page is checked for new URLs at most once a day
+DISCOVERY_MAX_AGE_SECONDS = 24 * 60 * 60
 
 # load the datasets.xlsx file from the root folder, being sure to include the data types
 dtypes = {'country': str, 'study': str, 'year': str, 'url': str, 'filename': str,
-          'link_valid': int, 'added': 'datetime64[ns]', 'chart_title': str, 
+          'link_valid': int, 'added': 'datetime64[ns]', 'chart_title': str,
           'comment': str}
 
-# try to read the datasets sheet using the dtypes given
-try:
-    datasets = pd.read_excel(excel_file, sheet_name='datasets', dtype=dtypes)
-except ValueError:
-    ws.logger.error("Error reading %s Check the data types.", DATASETS_PATH)
-    sys.exit(1)
-
-# a token map is a translation table of URL tokens to standardized names used in the project
-token_maps = tables.copy()
-token_maps.remove('datasets')
-
-# check that each of the token maps exists in the file
-for token_map in token_maps:
-    if token_map not in pd.ExcelFile(DATASETS_PATH).sheet_names:
-        ws.logger.error("Sheet '%s' not found in %s", token_map, DATASETS_PATH)
+
+def load_datasets_file():
+    """Returns the datasets sheet and the study and country token maps from datasets.xlsx."""
+    # Open the Excel file once and create an ExcelFile object
+    try:
+        excel_file = pd.ExcelFile(DATASETS_PATH)
+    except FileNotFoundError:
+        ws.logger.error("File not found: %s", DATASETS_PATH)
         sys.exit(1)
 
-# build a dict of table_name: df by looping through the table_names list
-tables = {table_name: pd.read_excel(excel_file, sheet_name=table_name)
-          for table_name in token_maps}
+    tables = ['datasets', 'study_map', 'country_map']
+
+    # check that each of the tables exists in the file
+    for table in tables:
+        if table not in excel_file.sheet_names:
+            ws.logger.error("Sheet '%s' not found in %s", table, DATASETS_PATH)
+            sys.exit(1)
+
+    # try to read the datasets sheet using the dtypes given
+    try:
+        datasets = pd.read_excel(excel_file, sheet_name='datasets', dtype=dtypes)
+    except ValueError:
+        ws.logger.error("Error reading %s Check the data types.", DATASETS_PATH)
+        sys.exit(1)
 
-def get_token_map(table_name):
-    """Return a dict of URL tokens to standardized names from the token_maps dict."""
-    # print(tables[table_name].columns)
-    return dict(zip(tables[table_name].token, tables[table_name].name))
+    # a token map is a translation table of URL tokens to standardized names used in the project
+    token_maps = {table_name: pd.read_excel(excel_file, sheet_name=table_name)
+                  for table_name in tables if table_name != 'datasets'}
 
-study_map = get_token_map('study_map')
-country_map = get_token_map('country_map')
+    def get_token_map(table_name):
+        """Return a dict of URL tokens to standardized names from the token_maps dict."""
+        return dict(zip(token_maps[table_name].token, token_maps[table_name].name))
 
+    return datasets, get_token_map('study_map'), get_token_map('country_map')
 
 
-# get the links from the rankings page (somewhat slow)
-links = ws.get_available_rankings()
+def discover():
+    """Saves the links from the rankings page (somewhat slow)."""
+    links = ws.get_available_rankings()
+    if not links:
+        ws.logger.warning("No rankings found on the rankings page")
+        # carry on with the links found last time, if there are any
+        return os.path.exists(AVAILABLE_RANKINGS_PATH)
+    with open(AVAILABLE_RANKINGS_PATH, 'w', encoding='utf-8') as f:
+        json.dump(sorted(links), f, indent=2)
+    return True
 
-# the core part of the URL for each dataset
-core_parts = datasets.url.apply(utils.get_core_url_part)
 
-# check if the available URL retrieved is already in the file or not
-output = {link: (core_parts == utils.get_core_url_part(link)).any() for link in links}
+def register(datasets, study_map, country_map):
+    """Adds the discovered links that are not in the datasets file to the datasets table."""
+    if not os.path.exists(AVAILABLE_RANKINGS_PATH):
+        ws.logger.warning("No discovered rankings to register in %s", AVAILABLE_RANKINGS_PATH)
+        return False
+    with open(AVAILABLE_RANKINGS_PATH, encoding='utf-8') as f:
+        links = json.load(f)
 
-# return the links that are not in the file
-new_urls = {k: v for k, v in output.items() if not v}
+    # the core part of the URL for each dataset
+    core_parts = datasets.url.apply(utils.get_core_url_part)
+
+    # return the links that are not in the file
+    new_urls = [link for link in links
+                if not (core_parts == utils.get_core_url_part(link)).any()]
+
+    if not new_urls:
+        ws.logger.info("There were no new urls to add to the datasets file.")
 
-# loop through the new URLs and add them to the datasets file
-if new_urls:
     for url in new_urls:
         core_part = utils.get_core_url_part(url)
         result = utils.predict_country_study_year(core_part=core_part,
-                                            country_map=country_map,
-                                            study_map=study_map)
+                                                  country_map=country_map,
+                                                  study_map=study_map)
+        if result is None:
+            continue
 
         data_dict = dict(zip(['country', 'study', 'year'], result))
         data_dict['url'] = url
-        # new_row = utils.add_new_dataset(data_dict=data_dict)
-        new_row = utils.insert_new_dataset(data_dict=data_dict)
-else:
-    ws.logger.info("There were no new urls to add to the datasets file.")
+        utils.insert_new_dataset(data_dict=data_dict)
+
+
+def ingest(row, filename):
+    """Loads the current view of a ranking file into rankings_raw."""
+    df_dataset = data.sqlselect(
+        "SELECT dataset_id FROM datasets WHERE filename IN (?, ?) LIMIT 1",
+        (row['filename'], os.path.basename(filename.replace('\\', '/')))
+    )
+    if df_dataset is None or df_dataset.empty:
+        ws.logger.error("No dataset_id found for %s", row['filename'])
+        return False
+    return data.ingest_rankings(int(df_dataset.iloc[0]['dataset_id']),
+                                delta.read_current(filename))
+
+
+def ensure_schema():
+    """Creates the search index and the aggregate tables that ingests keep up to date."""
+    index_ok = search.ensure_search_index()
+    aggregates_ok = aggregates.ensure_aggregates()
+    return index_ok and aggregates_ok
+
+
+def build_stages(datasets, study_map, country_map, refresh=False):
+    """
+    Builds the pipeline stages for every valid dataset.
+
+    Arguments:
+        refresh (bool) -- re-scrape rankings whose CSV file already exists
+    """
+    stages = [
+        pipeline.Stage('discovery', discover, outputs=[AVAILABLE_RANKINGS_PATH],
+                       max_age=DISCOVERY_MAX_AGE_SECONDS),
+        pipeline.Stage('registration', lambda: register(datasets, study_map, country_map),
+                       after=['discovery'], inputs=[AVAILABLE_RANKINGS_PATH, DATASETS_PATH]),
+        # runs once before the parallel ingests, whose triggers maintain these tables
+        pipeline.Stage('schema', ensure_schema,
+                       done=partial(data.schema_objects_exist, SCHEMA_OBJECTS)),
+    ]
+
+    export_inputs = []
+    clean_stages = []
+    # scrapes and the export only wait for discovery, registration and cleaning; a failure
+    # there must not hold up the datasets that are already known or files already cleaned
+    for _, row in datasets.loc[datasets.link_valid == 1].iterrows():
+        filename = '..\\' + row['filename']
+        stem = os.path.splitext(os.path.basename(row['filename'].replace('\\', '/')))[0]
+        raw_path = RAW_FOLDER_PATH / f'{stem}.json'
+        files = [filename, delta.get_delta_path(filename)]
+
+        stages += [
+            # an existing ranking is only scraped again on refresh, as in ws.to_csv
+            pipeline.Stage(f'scrape:{stem}', partial(ws.save_rows, row['url'], raw_path),
+                           after=['registration'], inputs=[row['url']],
+                           done=partial(lambda f: not refresh and os.path.exists(f), filename)),
+            pipeline.Stage(f'clean:{stem}', partial(ws.clean_saved_rows, raw_path, filename),
+                           deps=[f'scrape:{stem}'], inputs=[raw_path], outputs=[filename]),
+            pipeline.Stage(f'ingest:{stem}', partial(ingest, row, filename),
+                           deps=[f'clean:{stem}', 'schema'], inputs=files),
+        ]
+        export_inputs += files
+        clean_stages.append(f'clean:{stem}')
+
+    stages.append(pipeline.Stage(
+        'export',
+        lambda: ra.get_rankings_data().to_json(DATA_JSON_PATH, orient='records'),
+        after=clean_stages, inputs=export_inputs, outputs=[DATA_JSON_PATH]
+    ))
+    return stages
+
+
+def main():
+    """Runs the stale stages of the pipeline."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dry-run', action='store_true', help="show what would run")
+    parser.add_argument('--refresh', action='store_true',
+                        help="re-scrape rankings that were already downloaded")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="the number of stages to run in parallel")
+    args = parser.parse_args()
+
+    if not args.dry_run:
+        os.makedirs(RAW_FOLDER_PATH, exist_ok=True)
+    datasets, study_map, country_map = load_datasets_file()
+    stages = build_stages(datasets, study_map, country_map, refresh=args.refresh)
+    outcomes = pipeline.run(stages, dry_run=args.dry_run, max_workers=args.workers)
+
+    if 'failed' in outcomes.values():
+        sys.exit(1)
+    ws.logger.info("Finished running the pipeline")
     sys.exit(0)
 
 
-# loop through the datasets and scrape the data
-for index, row in datasets.loc[datasets.link_valid == 1].iterrows():
-    url = row['url']
-    filename = '..\\' + row['filename']
-
-    # scrape from, save to, refresh file if exists?
-    ws.to_csv(url=url, filename=filename)
-
-# load the data
-df_filedata = ra.get_rankings_data()
-df_filedata.to_json('..\\data\\data.json', orient='records')
-
-ws.logger.info("Finished writing data.json")
-sys.exit(0)
+if __name__ == '__main__':
+    main()
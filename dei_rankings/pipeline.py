@@ -0,0 +1,231 @@
+"""
+This module provides a small dependency-aware scheduler for the rankings pipeline.
+
+Each stage declares the stages it depends on, the inputs it reads and the files it writes.
+A stage can also be ordered after other stages without depending on their success, e.g. an
+export that reads whatever files the cleaning stages managed to write.
+After a stage succeeds, a fingerprint of its inputs is recorded in a manifest. A run only
+executes stages that are stale and runs stages whose dependencies are complete in parallel.
+
+A stage is stale when:
+    its done callable (if given) returns False, or otherwise
+    one of its outputs is missing,
+    it has never run or its input fingerprint changed since it last ran, or
+    it ran longer than max_age seconds ago
+
+Functions:
+    fingerprint: hashes files and values into a fingerprint
+    plan: returns what a run would do without running anything
+    run: runs the stale stages
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+from dei_rankings import logging_config, data
+
+logger = logging_config.logger
+
+MANIFEST_PATH = data.DATA_FOLDER_PATH / 'pipeline_manifest.json'
+
+
+@dataclass
+class Stage:
+    """
+    A node in the pipeline.
+
+    Attributes:
+        name -- unique name of the stage, e.g. 'scrape:r_statista_dei_usa_2024'
+        func -- called without arguments to run the stage, returning False marks it as failed
+        deps -- names of the stages that must complete first; if one fails, the stage is blocked
+        after -- names of the stages that must finish first, whether or not they succeed
+        inputs -- file paths and values the stage reads; files are fingerprinted by content
+        outputs -- files the stage writes
+        max_age -- seconds after which the stage is stale regardless of its inputs
+        done -- optional callable deciding freshness instead of outputs and fingerprints
+    """
+    name: str
+    func: Callable[[], Optional[bool]]
+    deps: List[str] = field(default_factory=list)
+    after: List[str] = field(default_factory=list)
+    inputs: List = field(default_factory=list)
+    outputs: List = field(default_factory=list)
+    max_age: Optional[float] = None
+    done: Optional[Callable[[], bool]] = None
+
+
+def fingerprint(inputs) -> str:
+    """
+    Hashes the contents of the files and the values of everything else in inputs.
+    A missing file is hashed by its path.
+    """
+    digest = hashlib.sha256()
+    for item in inputs:
+        path = os.fspath(item) if isinstance(item, os.PathLike) else item
+        if isinstance(path, str) and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        else:
+            digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+def load_manifest(path=MANIFEST_PATH) -> Dict:
+    """Returns the recorded fingerprints and run times by stage name."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: Dict, path=MANIFEST_PATH):
+    """Writes the manifest to disk."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def is_stale(stage: Stage, manifest: Dict) -> bool:
+    """Returns True if the stage needs to run."""
+    if stage.done is not None:
+        return not stage.done()
+    if not all(os.path.exists(output) for output in stage.outputs):
+        return True
+    record = manifest.get(stage.name)
+    if record is None or record['fingerprint'] != fingerprint(stage.inputs):
+        return True
+    if stage.max_age is not None:
+        age = datetime.now() - datetime.fromisoformat(record['ran_at'])
+        return age.total_seconds() > stage.max_age
+    return False
+
+
+def _check_graph(stages: List[Stage]) -> Dict[str, Stage]:
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = [dep for dep in stage.deps + stage.after if dep not in by_name]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stages {missing}")
+
+    # walk the graph to reject cycles
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle through stage '{name}'")
+        visiting.add(name)
+        for dep in by_name[name].deps + by_name[name].after:
+            visit(dep)
+        visiting.remove(name)
+        visited.add(name)
+
+    for name in by_name:
+        visit(name)
+    return by_name
+
+
+def plan(stages: List[Stage], manifest: Optional[Dict] = None) -> Dict[str, str]:
+    """
+    Returns what a run would do for each stage without running anything:
+        'run' -- the stage is stale
+        'maybe' -- the stage is fresh now but depends on or runs after a stage that will run
+        'skip' -- the stage and everything it depends on are fresh
+    A stage with a done callable is 'run' or 'skip' as done() decides, as in run().
+    """
+    by_name = _check_graph(stages)
+    manifest = load_manifest() if manifest is None else manifest
+    actions = {}
+
+    def action(name):
+        if name not in actions:
+            upstream = [action(dep) for dep in by_name[name].deps + by_name[name].after]
+            if by_name[name].done is not None:
+                actions[name] = 'skip' if by_name[name].done() else 'run'
+            elif is_stale(by_name[name], manifest):
+                actions[name] = 'run'
+            elif any(dep != 'skip' for dep in upstream):
+                actions[name] = 'maybe'
+            else:
+                actions[name] = 'skip'
+        return actions[name]
+
+    for name in by_name:
+        action(name)
+    return actions
+
+
+def run(stages: List[Stage], dry_run: bool = False, max_workers: int = 4) -> Dict[str, str]:
+    """
+    Runs the stale stages, each as soon as the stages it depends on or runs after have
+    finished.
+
+    Arguments:
+        stages (list) -- the stages of the pipeline
+        dry_run (bool) -- only log and return the plan
+        max_workers (int) -- the maximum number of stages running at the same time
+
+    Returns:
+        dict -- the outcome of each stage: 'ran', 'skipped', 'failed' or 'blocked' (a
+        dependency failed). With dry_run, the plan from plan().
+    """
+    by_name = _check_graph(stages)
+    manifest = load_manifest()
+
+    if dry_run:
+        actions = plan(stages, manifest)
+        for name, action in actions.items():
+            logger.info("%-5s %s", action, name)
+        logger.info("Would run %d of %d stages",
+                    list(actions.values()).count('run'), len(actions))
+        return actions
+
+    outcomes = {}
+    lock = threading.Lock()
+
+    def execute(stage):
+        # staleness is decided once the dependencies have finished and written their outputs
+        if not is_stale(stage, manifest):
+            return 'skipped'
+        inputs_fingerprint = fingerprint(stage.inputs)
+        logger.info("Running stage %s", stage.name)
+        if stage.func() is False:
+            return 'failed'
+        with lock:
+            manifest[stage.name] = {'fingerprint': inputs_fingerprint,
+                                    'ran_at': datetime.now().isoformat(timespec='seconds')}
+            save_manifest(manifest)
+        return 'ran'
+
+    pending = dict(by_name)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                dep_outcomes = [outcomes.get(dep) for dep in stage.deps]
+                if any(outcome in ('failed', 'blocked') for outcome in dep_outcomes):
+                    outcomes[name] = 'blocked'
+                    del pending[name]
+                elif all(outcomes.get(dep) is not None for dep in stage.deps + stage.after):
+                    running[executor.submit(execute, stage)] = name
+                    del pending[name]
+
+            if not running:
+                continue
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                name = running.pop(future)
+                try:
+                    outcomes[name] = future.result()
+                except Exception as e:
+                    logger.error("Stage %s failed: %s", name, e)
+                    outcomes[name] = 'failed'
+
+    summary = {outcome: list(outcomes.values()).count(outcome)
+               for outcome in ('ran', 'skipped', 'failed', 'blocked')}
+    logger.info("Pipeline finished: %s", summary)
+    return outcomes
@@ -2,10 +2,12 @@
 This module provides web scraping capabilities to extract rankings from r.statista.com.
 """
 
+import json
 from os.path import exists
 from typing import List
+import time
 import traceback
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from selenium.webdriver.support.ui import Select
 # from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.support import expected_conditions as EC
@@ -16,37 +18,204 @@ from selenium import webdriver
 import pandas as pd
 from bs4 import BeautifulSoup
 import requests
-from dei_rankings import logging_config
+from dei_rankings import logging_config, delta
 
 
 logger = logging_config.logger
 LOAD_WAIT_SECONDS = 10
+PAGE_WAIT_SECONDS = 5
+POLL_INITIAL_SECONDS = 0.05
+POLL_MAX_SECONDS = 0.5
 
-def get_selenium_driver():
+RANKING_TABLE_SELECTOR = "#statistaEmployerRankingTable, #statistaRankingTableLocalRanking"
+
+# Hooks the DataTables draw event (when jQuery is present) and returns a snapshot of the table:
+# the number of completed draws, the first-row rank, the row count and whether a draw is running
+TABLE_STATE_JS = """
+const table = document.querySelector(arguments[0]);
+if (!table) { return null; }
+if (window.jQuery && table.dataset.deiDrawHook === undefined) {
+    table.dataset.deiDrawHook = '0';
+    window.jQuery(table).on('draw.dt', function () {
+        table.dataset.deiDrawHook = String(Number(table.dataset.deiDrawHook) + 1);
+    });
+}
+const cell = table.querySelector('tbody tr td');
+const processing = document.querySelector('.dataTables_processing, .dt-processing');
+return {
+    draws: table.dataset.deiDrawHook === undefined ? null : Number(table.dataset.deiDrawHook),
+    first_rank: cell ? cell.textContent.trim() : null,
+    rows: table.querySelectorAll('tbody tr').length,
+    processing: processing ? processing.offsetParent !== null : false
+};
+"""
+
+# A lean browsing profile only loads what is needed to read the ranking table. Resource types
+# are blocked by URL pattern through the DevTools Network domain.
+LEAN_PROFILE = {
+    "page_load_strategy": "eager",
+    "disable_images": True,
+    "disable_extensions": True,
+    "blocked_resource_types": ["image", "font", "media"],
+    "blocked_url_patterns": [
+        "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+        "*googlesyndication.com*", "*facebook.net*", "*hotjar.com*", "*cookielaw.org*",
+    ],
+}
+
+RESOURCE_TYPE_PATTERNS = {
+    "image": ["*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.svg*", "*.webp*", "*.ico*"],
+    "font": ["*.woff*", "*.woff2*", "*.ttf*", "*.otf*", "*.eot*"],
+    "media": ["*.mp4*", "*.webm*", "*.mp3*"],
+    "stylesheet": ["*.css*"],
+}
+
+IS_CURRENT_PAGE_JS = """
+const link = document.querySelector(arguments[0]);
+return !!link && (link.classList.contains('current') ||
+                  link.getAttribute('aria-current') === 'page' ||
+                  link.parentElement.classList.contains('active'));
+"""
+
+def get_selenium_driver(profile=None):
     """
     Initializes and returns a Selenium WebDriver with default settings.
+
+    Arguments:
+        profile (dict) -- optional browsing profile such as LEAN_PROFILE. Defaults to a full
+            browser that loads every resource.
     """
+    profile = profile or {}
     options = Options()
     options.add_argument("--headless")
-    # options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    if profile.get("page_load_strategy"):
+        options.page_load_strategy = profile["page_load_strategy"]
+    if profile.get("disable_images"):
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_experimental_option(
+            "prefs", {"profile.managed_default_content_settings.images": 2}
+        )
+    if profile.get("disable_extensions"):
+        options.add_argument("--disable-extensions")
+    # the performance log carries the DevTools network events used by load_page
+    options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
     # options.add_experimental_option('excludeSwitches', ['enable-logging'])
     # driver = webdriver.Chrome(
     #     service=Service(ChromeDriverManager().install()), options=options
     # )
     driver = webdriver.Chrome(options=options)
-    driver.implicitly_wait(LOAD_WAIT_SECONDS)
+    # readiness is detected with explicit waits, an implicit wait would stall every empty lookup
+    driver.implicitly_wait(0)
+
+    blocked_urls = list(profile.get("blocked_url_patterns", []))
+    for resource_type in profile.get("blocked_resource_types", []):
+        blocked_urls.extend(RESOURCE_TYPE_PATTERNS.get(resource_type, []))
+    if blocked_urls:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_urls})
     return driver
 
-def get_available_rankings(url="https://r.statista.com/en/employers/"):
+def get_network_metrics(driver):
     """
-    Retrieves a list of available ranking URLs from the given source page.
+    Drains the performance log and sums the DevTools network events recorded since the last
+    call: bytes received on the wire (encodedDataLength), requests sent and requests blocked.
     """
-    driver = get_selenium_driver()
+    metrics = {"bytes": 0, "requests": 0, "blocked": 0}
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        if message["method"] == "Network.loadingFinished":
+            metrics["bytes"] += message["params"].get("encodedDataLength", 0)
+        elif message["method"] == "Network.requestWillBeSent":
+            metrics["requests"] += 1
+        elif message["method"] == "Network.loadingFailed" and \
+                message["params"].get("blockedReason"):
+            metrics["blocked"] += 1
+    return metrics
+
+def load_page(driver, url, until=None):
+    """
+    Navigates to url, waits until the page is ready and logs the bytes transferred, the
+    number of requests (and blocked requests) and the time until it was ready.
+
+    Arguments:
+        driver -- the Selenium WebDriver
+        url (str) -- the page to load
+        until -- optional callable taking the driver that waits for the content we read,
+            e.g. the first draw of the ranking table. Its exceptions are passed on.
+
+    Returns:
+        dict -- bytes, requests, blocked and load_ms
+    """
+    get_network_metrics(driver)  # discard events from earlier pages
+    start = time.perf_counter()
     driver.get(url)
+    if until is not None:
+        until(driver)
+    load_ms = (time.perf_counter() - start) * 1000
+    metrics = get_network_metrics(driver)
+    metrics["load_ms"] = round(load_ms)
+    logger.info("Loaded %s: %.1f KB in %d requests (%d blocked), %d ms",
+                url, metrics["bytes"] / 1024, metrics["requests"], metrics["blocked"],
+                metrics["load_ms"])
+    return metrics
+
+def get_table_state(driver):
+    """
+    Returns a snapshot of the ranking table (draw count, first-row rank, row count, processing).
+    Returns None if the table is not on the page yet.
+    """
+    return driver.execute_script(TABLE_STATE_JS, RANKING_TABLE_SELECTOR)
+
+def wait_for_table_draw(driver, previous_state, timeout=PAGE_WAIT_SECONDS):
+    """
+    Waits until the ranking table has been redrawn since previous_state was taken.
+
+    A redraw is signalled by the DataTables draw event or, where that cannot be hooked, by a
+    change in the first-row rank or the row count. Polling starts short and backs off
+    towards POLL_MAX_SECONDS.
 
-    links = driver.find_elements(
+    Arguments:
+        driver -- the Selenium WebDriver showing the ranking page
+        previous_state (dict) -- the table state from get_table_state before the redraw
+        timeout (float) -- seconds to wait before raising TimeoutException
+
+    Returns:
+        float -- the number of seconds spent waiting
+    """
+    start = time.perf_counter()
+    interval = POLL_INITIAL_SECONDS
+    while True:
+        state = get_table_state(driver)
+        if state and not state['processing'] and state['first_rank']:
+            if previous_state is None:
+                return time.perf_counter() - start
+            if state['draws'] is not None and previous_state['draws'] is not None:
+                if state['draws'] > previous_state['draws']:
+                    return time.perf_counter() - start
+            elif (state['first_rank'], state['rows']) != \
+                    (previous_state['first_rank'], previous_state['rows']):
+                return time.perf_counter() - start
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= timeout:
+            raise TimeoutException(f"Table was not redrawn within {timeout} seconds")
+        time.sleep(min(interval, timeout - elapsed))
+        interval = min(interval * 2, POLL_MAX_SECONDS)
+
+def get_available_rankings(url="https://r.statista.com/en/employers/", profile=None):
+    """
+    Retrieves a list of available ranking URLs from the given source page.
+    """
+    driver = get_selenium_driver(profile=LEAN_PROFILE if profile is None else profile)
+    link_locator = (
         By.XPATH, "//a[contains(@href, '://r.statista.com') and contains(@href, 'employers')]"
     )
+    try:
+        load_page(driver, url, until=lambda d: WebDriverWait(d, LOAD_WAIT_SECONDS).until(
+            EC.presence_of_all_elements_located(link_locator)))
+        links = driver.find_elements(*link_locator)
+    except TimeoutException:
+        links = []
     href_list = list(set(
         link.get_attribute("href") for link in links if 'claim' not in link.get_attribute('href')
     ))
@@ -58,64 +227,86 @@ def is_valid_ranking_page(driver, link):
     """
     Checks if the given ranking page contains a valid table with a 'Rank' column.
     """
-    driver.get(link)
     try:
-        driver.find_element(By.XPATH, "//th[text()='Rank']")
+        load_page(driver, link, until=lambda d: WebDriverWait(d, LOAD_WAIT_SECONDS).until(
+            EC.presence_of_element_located((By.XPATH, "//th[text()='Rank']"))
+        ))
         return True
-    except NoSuchElementException:
+    except TimeoutException:
         return False
 
-def get_rows_from_url(url: str) -> List[List]:
+def click_page(driver, page, wait_times, attempts=2):
+    """
+    Clicks a pagination link and waits for the table to be redrawn, clicking again once if
+    the first click did not draw the page.
+
+    Returns:
+        bool: True if the page was drawn, False otherwise.
+    """
+    for attempt in range(1, attempts + 1):
+        state = get_table_state(driver)
+        driver.execute_script(
+            f"document.querySelector('a[data-dt-idx=\"{page}\"]').click()"
+        )
+        try:
+            wait_times.append(wait_for_table_draw(driver, state))
+            return True
+        except TimeoutException:
+            logger.warning("Page %d was not drawn after attempt %d", page, attempt)
+    return False
+
+def get_rows_from_url(url: str, profile=None) -> List[List]:
     """
     Extracts ranking data from the given URL and returns it as a list of rows.
+    Uses LEAN_PROFILE unless another browsing profile is given.
     """
-    driver = get_selenium_driver()
-    driver.get(url)
+    driver = get_selenium_driver(profile=LEAN_PROFILE if profile is None else profile)
     logger.info("Loading %s", url)
+    wait_times = []
     try:
+        # the page counts as loaded once the table has been drawn for the first time
+        load_page(driver, url, until=lambda d: wait_times.append(
+            wait_for_table_draw(d, None, timeout=LOAD_WAIT_SECONDS)))
         select = Select(WebDriverWait(driver, LOAD_WAIT_SECONDS).until(
             EC.presence_of_element_located((By.NAME, "statistaEmployerRankingTable_length"))
         ))
-        select.select_by_value('100')
-        logger.info("Selecting 100 rows per page")
-    except NoSuchElementException:
-        logger.error("Page-size drop-down not found")
+    except TimeoutException:
+        logger.error("Ranking table or page-size drop-down not found on %s", url)
+        driver.quit()
+        return None
+
+    try:
+        # selecting the page size that is already shown does not redraw the table
+        if select.first_selected_option.get_attribute('value') != '100':
+            state = get_table_state(driver)
+            select.select_by_value('100')
+            logger.info("Selecting 100 rows per page")
+            wait_times.append(wait_for_table_draw(driver, state))
+    except (NoSuchElementException, TimeoutException):
+        logger.error("Ranking table was not drawn with 100 rows per page")
+        driver.quit()
         return None
 
     rows = []
-    # for page in range(1, 6):  # Max 5 pages
-    #     logger.info("Waiting for page to load")
-    #     pagination_link = driver.find_elements(By.CSS_SELECTOR, f"a[data-dt-idx='{page}']")
-    #     logger.info("Pagination link: %s", pagination_link)
-    #     if not pagination_link:
-    #         logger.info("No more pages available. Stopping.")
-    #         break
-
-    #     logger.info("Processing page %d", page)
-    #     pagination_link[0].click()  # Click the page link
-        
-    #     WebDriverWait(driver, 5).until(
-    #         EC.presence_of_element_located((By.TAG_NAME, 'table'))
-    #     )
-    #     rows.extend(parse_table_html(driver.page_source))
     for page in range(1, 6):  # Max 5 pages
         logger.info("Processing page %d", page)
-        pagination_link = driver.find_elements(By.CSS_SELECTOR, f"a[data-dt-idx='{page}']")
-        if not pagination_link:
+        link_selector = f"a[data-dt-idx='{page}']"
+        if not driver.find_elements(By.CSS_SELECTOR, link_selector):
             logger.info("No more pages available. Stopping.")
             break
-        driver.execute_script(
-            f"document.querySelector('a[data-dt-idx=\"{page}\"]').click()"
-        )
-        WebDriverWait(driver, 5).until(
-            EC.presence_of_element_located((By.TAG_NAME, 'table'))
-        )
-        rows.extend(parse_table_html(driver.page_source))
 
+        # the first page is already drawn after the page-size change, clicking it draws nothing
+        if not driver.execute_script(IS_CURRENT_PAGE_JS, link_selector):
+            if not click_page(driver, page, wait_times):
+                # a partial ranking would be saved as if complete, so return nothing
+                logger.error("Page %d was not drawn, abandoning %s", page, url)
+                driver.quit()
+                return None
 
-        # if page == 2:
-        #     print(rows)
+        rows.extend(parse_table_html(driver.page_source))
 
+    logger.info("Waited %.2fs for %d table draws (max %.2fs)",
+                sum(wait_times), len(wait_times), max(wait_times, default=0))
     driver.quit()
     return rows
 
@@ -180,9 +371,38 @@ def safe_execute(func, *args, **kwargs):
         logger.error("Error in function %s: %s\n%s", func.__name__, str(e), traceback.format_exc())
         return None
 
+def save_rows(url, raw_path):
+    """
+    Scrapes the ranking rows from url and saves them unchanged as JSON to raw_path.
+
+    Returns:
+        bool: True if rows were found and saved, False otherwise.
+    """
+    rows = safe_execute(get_rows_from_url, url)
+    if not rows:
+        logger.error("No rows found at %s", url)
+        return False
+    with open(raw_path, 'w', encoding='utf-8') as f:
+        json.dump(rows, f)
+    logger.info("Saved %d raw rows to %s", len(rows), raw_path)
+    return True
+
+def clean_saved_rows(raw_path, filename):
+    """
+    Cleans the rows saved by save_rows and writes them to filename through the delta log.
+    Does nothing if there are no saved rows, e.g. for rankings scraped before they were kept.
+    """
+    if not exists(raw_path):
+        logger.info("No saved rows for %s", filename)
+        return
+    with open(raw_path, encoding='utf-8') as f:
+        rows = json.load(f)
+    delta.write_rankings(clean_rows(rows), filename)
+
 def to_csv(url, filename, force_refresh=False):
     """
     Retrieves, cleans, and saves ranking data to a CSV file if updates are detected.
+    A refresh of an existing file only appends the changed rows to its delta log.
     """
     # etag = get_etag(url)
     if not exists(filename) or force_refresh is True:
@@ -195,4 +415,4 @@ def to_csv(url, filename, force_refresh=False):
     # rows = safe_execute(get_rows_from_url, url)
     if rows:
         df = clean_rows(rows)
-        df.to_csv(filename, index=False)
+        delta.write_rankings(df, filename)
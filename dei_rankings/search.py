@@ -0,0 +1,148 @@
+"""
+This module provides full-text search over the ranking rows stored in the SQLite database.
+
+The rankings_fts table is an FTS5 index over the company, ceo, hq, state and industry columns
+of rankings_raw. It reads its content from rankings_raw and is kept in sync by triggers.
+
+Functions:
+    create_search_index: creates the index and its triggers and builds it from rankings_raw
+    ensure_search_index: creates the index only if it or one of its triggers is missing
+    rebuild_search_index: rebuilds the index from rankings_raw
+    search_rankings: ranked, prefix-aware search returning dataset metadata with each hit
+"""
+import re
+import pandas as pd
+from dei_rankings import logging_config, data
+
+logger = logging_config.logger
+
+FTS_TABLE = 'rankings_fts'
+FTS_COLUMNS = ['company', 'ceo', 'hq', 'state', 'industry']
+
+# bm25 weights in FTS_COLUMNS order, a match on the company name counts most
+FTS_WEIGHTS = [10.0, 2.0, 1.0, 1.0, 1.0]
+
+
+FTS_TRIGGERS = [f'{FTS_TABLE}_{event}' for event in ('insert', 'delete', 'update')]
+
+
+def _index_statements():
+    """Statements creating the index and its triggers if they do not exist."""
+    columns = ', '.join(FTS_COLUMNS)
+    new_values = ', '.join(f'new.{column}' for column in FTS_COLUMNS)
+    old_values = ', '.join(f'old.{column}' for column in FTS_COLUMNS)
+
+    return [
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            {columns},
+            content='rankings_raw', content_rowid='rankings_raw_id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON rankings_raw BEGIN
+            INSERT INTO {FTS_TABLE} (rowid, {columns})
+            VALUES (new.rankings_raw_id, {new_values});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON rankings_raw BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {columns})
+            VALUES ('delete', old.rankings_raw_id, {old_values});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE ON rankings_raw BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {columns})
+            VALUES ('delete', old.rankings_raw_id, {old_values});
+            INSERT INTO {FTS_TABLE} (rowid, {columns})
+            VALUES (new.rankings_raw_id, {new_values});
+        END
+        """,
+    ]
+
+
+REBUILD_STATEMENT = f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')"
+
+
+def create_search_index():
+    """
+    Creates the FTS5 index over rankings_raw, the triggers that keep it in sync and builds it
+    from the rows already stored.
+
+    Returns:
+        bool: True if the index was created and built successfully, False otherwise.
+    """
+    if not data.sqltransaction(_index_statements() + [REBUILD_STATEMENT]):
+        logger.error("Failed to create search index %s", FTS_TABLE)
+        return False
+    data.sqlddl(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    logger.info("Created search index %s", FTS_TABLE)
+    return True
+
+
+def ensure_search_index():
+    """
+    Creates and builds the search index if it or one of its triggers is missing.
+
+    Returns:
+        bool: True if the index is in place, False otherwise.
+    """
+    if not data.ensure_derived_table([FTS_TABLE, *FTS_TRIGGERS],
+                                     _index_statements() + [REBUILD_STATEMENT]):
+        logger.error("Failed to create search index %s", FTS_TABLE)
+        return False
+    return True
+
+
+def rebuild_search_index():
+    """Rebuilds the search index from the rows in rankings_raw."""
+    if not data.sqlddl(REBUILD_STATEMENT):
+        logger.error("Failed to rebuild search index %s", FTS_TABLE)
+        return False
+    data.sqlddl(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    logger.info("Rebuilt search index %s", FTS_TABLE)
+    return True
+
+
+def build_match_query(text: str, prefix: bool = True) -> str:
+    """
+    Turns free text into an FTS5 MATCH expression. Every word must match; with prefix=True
+    the words also match as prefixes, e.g. 'gold sach' finds Goldman Sachs.
+    """
+    tokens = re.findall(r'\w+', text)
+    suffix = '*' if prefix else ''
+    return ' '.join(f'"{token}"{suffix}' for token in tokens)
+
+
+def search_rankings(text: str, limit: int = 20, prefix: bool = True) -> pd.DataFrame:
+    """
+    Searches companies, CEOs, headquarters, states and industries in the stored rankings.
+
+    Arguments:
+        text (str) -- the words to search for
+        limit (int) -- the maximum number of hits to return
+        prefix (bool) -- match the words as prefixes (for search-as-you-type)
+
+    Returns:
+        A dataframe of matching ranking rows with the study, country, year, chart_title and
+        filename of their dataset, best matches first
+    """
+    match_query = build_match_query(text, prefix=prefix)
+    if not match_query:
+        return pd.DataFrame()
+
+    weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+    query = f"""
+    SELECT r.rankings_raw_id, r.rank, r.company, r.ceo, r.hq, r.state, r.industry, r.score,
+           d.dataset_id, d.study, d.country, d.year, d.chart_title, d.filename,
+           bm25({FTS_TABLE}, {weights}) AS relevance
+    FROM {FTS_TABLE}
+    JOIN rankings_raw r ON r.rankings_raw_id = {FTS_TABLE}.rowid
+    LEFT JOIN datasets d ON d.dataset_id = r.dataset_id
+    WHERE {FTS_TABLE} MATCH ?
+    ORDER BY relevance
+    LIMIT ?
+    """
+    return data.sqlselect(query, (match_query, limit))